@@ -1,13 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import ctypes
+import ctypes.util
+import errno
+import httplib
 import json
+import mmap
 import os
 import re
+import select
 import shutil
+import socket
 import subprocess as sp
 import sys
 import time
+from io import BytesIO
 
 import textwrap
 import requests
@@ -19,15 +27,39 @@ try:
 except ImportError:
     import xml.etree.ElementTree as eTree
 
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# reuse connections to oz_panel instead of doing a TLS handshake per request
+SESSION = requests.Session()
+
 LOGS = [('[oz_panel]', '/var/log/oz_panel'),
         ('[cluster_manager]', '/var/log/cluster_manager'),
         ('[oz_worker]', '/var/log/oz_worker')]
 LOG_LEVELS = ['debug', 'info', 'error']
 
+# maximum number of bytes read from a log file at once
+LOG_READ_SIZE = 65536
+# seconds between log checks when inotify is not available
+LOG_POLL_INTERVAL = 1
+# upper bound on a single inotify wait, in case some change was not reported
+LOG_WAIT_TIMEOUT = 60
+
+# flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
 ONEPANEL_OVERRIDE = 'ONEPANEL_OVERRIDE'
 
+DOCKER_SOCKET_PATH = '/var/run/docker.sock'
+
 
 GENERATED_CONFIG_SOURCES_PATH = '_build/default/rel/oz_panel/etc/autogenerated.config'
 VM_ARGS_SOURCES_PATH = '_build/default/rel/oz_panel/etc/vm.args'
@@ -35,34 +67,139 @@ VM_ARGS_SOURCES_PATH = '_build/default/rel/oz_panel/etc/vm.args'
 GENERATED_CONFIG_PACKAGES_PATH = '/etc/oz_panel/autogenerated.config'
 VM_ARGS_PACKAGES_PATH = '/etc/oz_panel/vm.args'
 
+NODE_NAME_PATTERN = re.compile(r'-name .*')
+CONFIG_INITIALIZED_PATTERN = re.compile(br'{config_initialized,\s*true}')
+
+# delays (in seconds) between consecutive attempts when waiting for services
+RETRY_DELAY_MIN = 0.25
+RETRY_DELAY_MAX = 30
+
+# delays (in seconds) between configuration progress checks, shortest
+# while new steps keep arriving
+STEPS_POLL_DELAY_MIN = 0.2
+STEPS_POLL_DELAY_MAX = 2
+
 
 class AuthenticationException(ValueError):
     pass
 
 
-def log(message, end='\n'):
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, socket_path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class LogWatcher(object):
+    # Waits until one of the log files may have new content. Sleeps in
+    # inotify when it is available and falls back to polling otherwise.
+
+    def __init__(self, log_files):
+        self.log_files = log_files
+        self.libc = None
+        self.fd = None
+        self.last_wake_up = 0
+
+        if not log_files:
+            return
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+
+        self.libc = libc
+        self.fd = fd
+        # rotated and newly created files show up as directory entries
+        for log_dir in set(os.path.dirname(f) for f in log_files):
+            if libc.inotify_add_watch(fd, log_dir,
+                                      IN_CREATE | IN_MOVED_TO) < 0:
+                self.stop_watching()
+                return
+        self.watch_files()
+
+    def watch_files(self):
+        # a watch follows the inode, so it is renewed after each wake-up to
+        # pick up rotated files; files which do not exist yet are skipped
+        for log_file in self.log_files:
+            if self.libc.inotify_add_watch(self.fd, log_file, IN_MODIFY) < 0 \
+                    and ctypes.get_errno() != errno.ENOENT:
+                self.stop_watching()
+                return
+
+    def stop_watching(self):
+        # without all watches in place fall back to polling
+        os.close(self.fd)
+        self.fd = None
+
+    def wait(self):
+        if self.fd is None:
+            time.sleep(LOG_POLL_INTERVAL)
+            return
+
+        select.select([self.fd], [], [], LOG_WAIT_TIMEOUT)
+        # busy logs are still checked at most once per LOG_POLL_INTERVAL
+        remaining = self.last_wake_up + LOG_POLL_INTERVAL - time.time()
+        if remaining > 0:
+            time.sleep(min(remaining, LOG_POLL_INTERVAL))
+
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        self.watch_files()
+        self.last_wake_up = time.time()
+
+
+def log_nosync(message, end='\n'):
     sys.stdout.write(message + end)
+
+
+def log(message, end='\n'):
+    log_nosync(message, end)
     sys.stdout.flush()
 
 
 def replace(file_path, pattern, value):
-    with open(file_path, 'rw+') as f:
-        content = f.read()
-        content = re.sub(pattern, value, content)
-        f.seek(0)
-        f.truncate()
+    with open(file_path, 'r') as f:
+        content = pattern.sub(value, f.read())
+
+    with open(file_path, 'w') as f:
         f.write(content)
 
 
 def set_node_name(file_path):
-    hostname = sp.check_output(['hostname', '-f']).rstrip('\n')
-    replace(file_path, r'-name .*', '-name onepanel@{0}'.format(hostname))
+    # resolve the canonical name like hostname -f does, getfqdn() would
+    # prefer the first alias from a reverse lookup instead
+    hostname = socket.gethostname()
+    canonical_name = socket.getaddrinfo(hostname, None, 0, 0, 0,
+                                        socket.AI_CANONNAME)[0][3]
+    hostname = canonical_name or hostname
+    replace(file_path, NODE_NAME_PATTERN,
+            '-name onepanel@{0}'.format(hostname))
 
 
 def config_file_initialized(file_path):
-    with open(file_path, 'r') as f:
-        content = f.read()
-        return bool(re.search(r'{config_initialized,\s*true}', content))
+    with open(file_path, 'rb') as f:
+        # empty files cannot be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+
+        content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return bool(CONFIG_INITIALIZED_PATTERN.search(content))
+        finally:
+            content.close()
 
 
 def generate_config_file(file_path):
@@ -109,15 +246,17 @@ def start_onepanel():
 def wait_for_rest_listener():
     first = True
     connected = False
+    delay = RETRY_DELAY_MIN
     while not connected:
         try:
-            requests.get('https://127.0.0.1:9443/api/v3/onepanel/', verify=False)
+            SESSION.get('https://127.0.0.1:9443/api/v3/onepanel/', verify=False)
         except requests.ConnectionError:
             if first:
                 log('Waiting for oz_panel server to be available\n'
                     '(may require starting other cluster nodes)\n')
                 first = False
-            time.sleep(1)
+            time.sleep(delay)
+            delay = min(delay * 2, RETRY_DELAY_MAX)
         else:
             connected = True
 
@@ -139,9 +278,11 @@ def get_users(config):
 
 
 def do_request(users, request, *args, **kwargs):
-    for (username, password) in users:
+    for i, (username, password) in enumerate(users):
         r = request(*args, auth=(username, password), **kwargs)
         if r.status_code != 401 and r.status_code != 403:
+            # try the accepted credentials first in subsequent requests
+            users.insert(0, users.pop(i))
             return r
 
     raise AuthenticationException('Authorization error.\n'
@@ -151,7 +292,7 @@ def do_request(users, request, *args, **kwargs):
 
 def get_batch_config():
     batch_config = os.environ.get('ONEZONE_CONFIG', '')
-    batch_config = yaml.load(batch_config)
+    batch_config = yaml.load(batch_config, Loader=YamlLoader)
     if not batch_config:
         return {}
 
@@ -168,10 +309,10 @@ def get_batch_config():
 def configure(config):
     users = get_users(config)
 
-    r = do_request(users, requests.post,
+    r = do_request(users, SESSION.post,
                    'https://127.0.0.1:9443/api/v3/onepanel/zone/configuration',
                    headers={'content-type': 'application/x-yaml'},
-                   data=yaml.dump(config),
+                   data=yaml.dump(config, Dumper=YamlDumper),
                    verify=False)
 
     if r.status_code == 409:
@@ -187,12 +328,13 @@ def configure(config):
 
     loc = r.headers['location']
     status = 'running'
-    steps = []
+    logged_steps = 0
+    delay = STEPS_POLL_DELAY_MIN
     resp = {}
 
     log('\nConfiguring onezone:')
     while status == 'running':
-        r = do_request(users, requests.get,
+        r = do_request(users, SESSION.get,
                        'https://127.0.0.1:9443' + loc,
                        verify=False)
         if r.status_code != 200:
@@ -201,13 +343,18 @@ def configure(config):
         else:
             resp = json.loads(r.text)
             status = resp.get('status', 'error')
-            for step in resp.get('steps', []):
-                if steps and step == steps[0]:
-                    steps = steps[1:]
-                else:
-                    log(format_step(step))
             steps = resp.get('steps', [])
-            time.sleep(1)
+            for step in steps[logged_steps:]:
+                log(format_step(step))
+
+            if len(steps) > logged_steps:
+                delay = STEPS_POLL_DELAY_MIN
+            else:
+                delay = min(delay * 2, STEPS_POLL_DELAY_MAX)
+            logged_steps = len(steps)
+
+            if status == 'running':
+                time.sleep(delay)
 
     if status != 'ok':
         raise ValueError('Error: {error}\nDescription: {description}\n'
@@ -222,31 +369,35 @@ def configure(config):
 
 
 def format_error_hosts(hosts):
-    s = '\n'
+    parts = ['\n']
     for host, details in hosts.iteritems():
         description = textwrap.fill(details.get('description', ''),
                                     initial_indent='\t', subsequent_indent='\t')
-        s = s + '* {host}\n\t{error}:\n{description}\n'.format(
-            host=host, error=details.get('error', ''), description=description)
-    return s
+        parts.append('* {host}\n\t{error}:\n{description}\n'.format(
+            host=host, error=details.get('error', ''), description=description))
+    return ''.join(parts)
 
 
 # Throws on connection nerror
 def wait_for_workers(config):
     url = 'https://127.0.0.1:9443/api/v3/onepanel/zone/nagios'
-    while not nagios_up(url, config):
-        time.sleep(1)
-
-
-def nagios_up(url, config):
     users = get_users(config)
+    delay = RETRY_DELAY_MIN
+    while not nagios_up(url, users):
+        time.sleep(delay)
+        delay = min(delay * 2, RETRY_DELAY_MAX)
+
 
+def nagios_up(url, users):
     try:
-        r = do_request(users, requests.get, url, verify=False)
+        r = do_request(users, SESSION.get, url, verify=False)
         if r.status_code != requests.codes.ok:
             return False
 
-        healthdata = eTree.fromstring(r.text)
+        # only the status of the root element is needed, so stop parsing
+        # at its start tag
+        _, healthdata = next(eTree.iterparse(BytesIO(r.content),
+                                             events=('start',)))
         return healthdata.attrib['status'] == 'ok'
     except ValueError:
         log("Cannot track cluster start progress since there are no valid "
@@ -254,24 +405,26 @@ def nagios_up(url, config):
 
 
 def get_container_id():
-    with open('/proc/self/cgroup', 'r') as f:
-        return f.readline().split('/')[-1].rstrip('\n')
+    with open('/proc/self/cgroup', 'rb', 0) as f:
+        first_line = f.read().split('\n', 1)[0]
+        return first_line.rsplit('/', 1)[-1]
 
 
 def inspect_container(container_id):
+    conn = UnixHTTPConnection(DOCKER_SOCKET_PATH)
     try:
-        result = sp.check_output(['curl', '-s', '--unix-socket',
-                                  '/var/run/docker.sock', 'http:/containers/{0}/json'.
-                                  format(container_id)])
-        return json.loads(result)
+        conn.request('GET', '/containers/{0}/json'.format(container_id))
+        return json.loads(conn.getresponse().read())
     except Exception:
         return {}
+    finally:
+        conn.close()
 
 
 def show_ip_address(json):
     ip = '-'
     try:
-        ip = sp.check_output(['hostname', '-i']).rstrip('\n')
+        ip = socket.gethostbyname(socket.gethostname())
         ip = json['NetworkSettings']['Networks'].items()[0][1]['IPAddress']
     except Exception:
         pass
@@ -309,32 +462,62 @@ def infinite_loop(log_level):
         log('\nLogging on \'{0}\' level:'.format(log_level))
         for log_prefix, log_dir in LOGS:
             log_file = os.path.join(log_dir, log_level + '.log')
-            logs.append((log_prefix, log_file, None, None))
+            logs.append((log_prefix, log_file, None, None, True))
 
+    watcher = LogWatcher([log_file for _, log_file, _, _, _ in logs])
     while True:
         logs = print_logs(logs)
-        time.sleep(1)
+        sys.stdout.flush()
+        watcher.wait()
+
+
+# returns the chunk with log_prefix inserted at the start of each line and
+# whether the chunk ends at a line boundary
+def format_log_chunk(log_prefix, content, line_start):
+    lines = content.split('\n')
+    tail = lines.pop()
+    output = []
+
+    for line in lines:
+        if line_start:
+            output.append('{0} {1}\n'.format(log_prefix, line))
+        else:
+            output.append(line + '\n')
+        line_start = True
+
+    if tail:
+        if line_start:
+            output.append('{0} {1}'.format(log_prefix, tail))
+        else:
+            output.append(tail)
+        line_start = False
+
+    return ''.join(output), line_start
 
 
 def print_logs(logs):
     new_logs = []
 
-    for log_prefix, log_file, log_fd, log_ino in logs:
+    for log_prefix, log_file, log_fd, log_ino, line_start in logs:
         try:
             if os.stat(log_file).st_ino != log_ino:
                 if log_fd:
                     log_fd.close()
                 log_fd = open(log_file, 'r')
-                log_ino = os.stat(log_file).st_ino
-
-            log_line = log_fd.readline()
-            while log_line:
-                log('{0} {1}'.format(log_prefix, log_line), end='')
-                log_line = log_fd.readline()
-
-            new_logs.append((log_prefix, log_file, log_fd, log_ino))
+                log_ino = os.fstat(log_fd.fileno()).st_ino
+                line_start = True
+
+            content = os.read(log_fd.fileno(), LOG_READ_SIZE)
+            while content:
+                output, line_start = format_log_chunk(log_prefix, content,
+                                                      line_start)
+                log_nosync(output, end='')
+                content = os.read(log_fd.fileno(), LOG_READ_SIZE)
+
+            new_logs.append((log_prefix, log_file, log_fd, log_ino,
+                             line_start))
         except:
-            new_logs.append((log_prefix, log_file, None, None))
+            new_logs.append((log_prefix, log_file, None, None, True))
 
     return new_logs
 
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from multiprocessing.pool import ThreadPool
 from os.path import join
+import errno
 import os
 import sys
 import shutil
@@ -28,48 +30,96 @@ def create_symlinks():
         source_path = join(PERSISTENCE_DIR, dest_path[1:])
 
         if not os.path.isdir(source_path):
-            stat = os.stat(dest_path)
+            # the original directory may have been moved to the backup dir
+            if os.path.exists(dest_path):
+                stat = os.stat(dest_path)
+            else:
+                stat = os.stat(join(BACKUP_DIR, dest_path[1:]))
             os.makedirs(source_path)
             os.chown(source_path, stat.st_uid, stat.st_gid)
 
         if not os.path.islink(dest_path):
-            shutil.rmtree(dest_path)
+            if os.path.exists(dest_path):
+                shutil.rmtree(dest_path)
             os.symlink(source_path, dest_path)
 
 
 def backup_persistent_files():
     if not os.path.isdir(BACKUP_DIR):
         os.makedirs(BACKUP_DIR)
-    copy_missing_files(None, BACKUP_DIR)
+    map_dirs(backup_dir)
+
+
+def backup_dir(dir_path):
+    backup_path = join(BACKUP_DIR, dir_path[1:])
+
+    # create_symlinks() removes the original directory anyway, so move it
+    # when possible and copy it only across file systems
+    if os.path.isdir(dir_path) and not os.path.islink(dir_path) and \
+            not os.path.exists(backup_path):
+        try:
+            os.makedirs(os.path.dirname(backup_path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        try:
+            os.rename(dir_path, backup_path)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    copy_missing_dir(None, BACKUP_DIR, dir_path)
 
 
 # src can be None if there is no base dir
 def copy_missing_files(base_dir, dest):
-    for root_dir in DIRS:
-        if base_dir:
-            root_dir = join(base_dir, root_dir[1:])
+    map_dirs(lambda root_dir: copy_missing_dir(base_dir, dest, root_dir))
 
-        if not os.path.exists(root_dir):
-            os.makedirs(root_dir)
 
-        for subdir, _, files in os.walk(root_dir):
-            if base_dir:
-                subdir_path = join(dest, os.path.relpath(subdir, base_dir))
-            else:
-                subdir_path = join(dest, subdir[1:])
-
-            if not os.path.exists(subdir_path):
-                stat = os.stat(subdir)
-                os.makedirs(subdir_path)
-                os.chown(subdir_path, stat.st_uid, stat.st_gid)
-
-            for f in files:
-                source_path = join(subdir, f)
-                dest_path = join(subdir_path, f)
-                if not os.path.exists(dest_path):
-                    stat = os.stat(source_path)
-                    shutil.copy(source_path, dest_path)
-                    os.chown(dest_path, stat.st_uid, stat.st_gid)
+def map_dirs(function):
+    # directories are independent of each other, process them concurrently
+    pool = ThreadPool(len(DIRS))
+    try:
+        pool.map(function, DIRS)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def copy_missing_dir(base_dir, dest, root_dir):
+    if base_dir:
+        root_dir = join(base_dir, root_dir[1:])
+
+    try:
+        os.makedirs(root_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    for subdir, _, files in os.walk(root_dir):
+        if base_dir:
+            subdir_path = join(dest, os.path.relpath(subdir, base_dir))
+        else:
+            subdir_path = join(dest, subdir[1:])
+
+        try:
+            os.makedirs(subdir_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            stat = os.stat(subdir)
+            os.chown(subdir_path, stat.st_uid, stat.st_gid)
+
+        for f in files:
+            source_path = join(subdir, f)
+            dest_path = join(subdir_path, f)
+            if not os.path.exists(dest_path):
+                stat = os.stat(source_path)
+                shutil.copy(source_path, dest_path)
+                os.chown(dest_path, stat.st_uid, stat.st_gid)
 
 
 if __name__ == '__main__':